@@ -1,7 +1,12 @@
-import os
-import os.path
+import pathlib
+import functools
+import subprocess
+import orjson
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 CLIO_STORE_URL = {
     "prod": "https://clio-store-vwzoicitea-uk.a.run.app",
     "test": "https://clio-test-7fdj77ed7q-uk.a.run.app",
@@ -15,8 +20,13 @@ TOKEN_CACHE_FILE = "flyem_token.json"
 def get_identity_token() -> str:
     """Returns a Google identity token using installed gcloud or manual input"""
     try:
-        user_token = os.popen("gcloud auth print-identity-token").read()
-    except:
+        user_token = subprocess.run(
+            ["gcloud", "auth", "print-identity-token"],
+            capture_output=True,
+            text=True,
+            check=False,
+        ).stdout
+    except FileNotFoundError:
         print("Unable to get identity token from gcloud.  Is it installed?")
         print("Switching to manual entering of token from command line.")
         print("Copy and paste token from clio.janelia.org User Settings page.")
@@ -25,11 +35,12 @@ def get_identity_token() -> str:
     return user_token.rstrip()
 
 
+@functools.lru_cache(maxsize=1)
 def get_clio_token():
     """Returns a long-lived FlyEM token, possibly from local cached file"""
-    if os.path.exists(TOKEN_CACHE_FILE):
-        with open(TOKEN_CACHE_FILE, "r") as f:
-            return f.read()
+    token_file = pathlib.Path(TOKEN_CACHE_FILE)
+    if token_file.exists():
+        return token_file.read_text()
     else:
         user_token = get_identity_token()
         r = requests.post(
@@ -44,9 +55,6 @@ def get_clio_token():
         return flyem_token
 
 
-flyem_token = get_clio_token()
-
-
 def clio_url(store: str, endpoint: str) -> str:
     if store not in CLIO_STORE_URL:
         raise Exception(f'"{store}" is not a valid store. Use "prod" or "test"')
@@ -55,17 +63,33 @@ def clio_url(store: str, endpoint: str) -> str:
     return CLIO_STORE_URL[store] + "/v2/" + CLIO_ENDPOINTS[endpoint]
 
 
+def _make_session(token) -> requests.Session:
+    """Returns a keep-alive session carrying the FlyEM token"""
+    session = requests.Session()
+    retries = Retry(connect=2, backoff_factor=0.1)
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries),
+    )
+    session.headers.update({"Authorization": f"Bearer {token}"})
+    return session
+
+
+@functools.lru_cache(maxsize=1)
+def _session() -> requests.Session:
+    """Returns the shared session, fetching the token on first use"""
+    # Reusing one session avoids a new TCP+TLS handshake on every call
+    return _make_session(get_clio_token())
+
+
 def post(store: str, endpoint: str, json_payload: dict = None, str_payload: str = None):
     if json_payload:
-        r = requests.post(
+        # orjson is much faster than the stdlib json requests would use
+        r = _session().post(
             clio_url(store, endpoint),
-            json=json_payload,
-            headers={"Authorization": f"Bearer {flyem_token}"},
+            data=orjson.dumps(json_payload),
+            headers={"Content-Type": "application/json"},
         )
     else:
-        r = requests.post(
-            clio_url(store, endpoint),
-            data=str_payload,
-            headers={"Authorization": f"Bearer {flyem_token}"},
-        )
+        r = _session().post(clio_url(store, endpoint), data=str_payload)
     return r.status_code, r.content
@@ -1,3 +1,3 @@
-from .client import Client, set_token, login
+from .client import Client, set_token, login, cache_clear
 from .pull import *
 from .push import *
@@ -2,14 +2,14 @@
 Client to interact with a Clio backend.
 """
 
-import os
 import jwt
 import json
-import copy
 import time
 import inspect
 import logging
 import functools
+import subprocess
+import weakref
 import requests
 import threading
 
@@ -27,14 +27,16 @@ from functools import lru_cache
 from requests import Session
 from requests.adapters import HTTPAdapter
 
+import numpy as np
 import pandas as pd
 
-# ujson is faster than Python's builtin json module
-import ujson
+# orjson is considerably faster than Python's builtin json module (and ujson)
+import orjson
 
 logger = logging.getLogger(__name__)
 DEFAULT_CLIO_CLIENT = None
-CLIO_CLIENTS = {}
+# All clients created in this session (so that `cache_clear` can reset them)
+CLIO_CLIENTS = weakref.WeakSet()
 CLIO_TOKEN_FILE = "~/clio_token.json"
 CLIO_TOKEN_URL = "https://clio-store-vwzoicitea-uk.a.run.app/v2/server/token"
 CLIO_TEST_STORE = "https://clio-test-7fdj77ed7q-uk.a.run.app"
@@ -43,35 +45,66 @@ CLIO_WEBSITE_URL = "https://clio.janelia.org"
 CLIO_SETTINGS_URL = f"{CLIO_WEBSITE_URL}/settings"
 
 
+def _dumps(obj):
+    """Serialize `obj` to JSON bytes (numpy scalars/arrays included).
+
+    NaNs are written as `null` by orjson itself, pandas' missing values
+    (pd.NA, pd.NaT) are handled by `_json_default`.
+    """
+    return orjson.dumps(obj, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def _json_default(obj):
+    """Serialize types orjson doesn't know about."""
+    if obj is pd.NA or obj is pd.NaT:
+        return None
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        # orjson only serializes C-contiguous arrays (e.g. not `x[::2]`)
+        return obj.tolist()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+@lru_cache(maxsize=512)
+def _add_identifier(url):
+    """Add identifier to URL.
+
+    Cached since the same handful of endpoints is requested over and over.
+    """
+    # Fast path for the common case of URLs without a query string
+    if "?" not in url and "#" not in url:
+        return url + "?app=clio-py"
+
+    url_parts = list(urlparse.urlparse(url))
+    query = dict(urlparse.parse_qsl(url_parts[4]))
+
+    if "app" not in query:
+        query.update({"app": "clio-py"})
+
+    url_parts[4] = urlencode(query)
+
+    return urlparse.urlunparse(url_parts)
+
+
 def default_client():
     """
     Obtain the default Client object to use.
-    This function returns a separate copy of the
-    default client for each thread (and process).
+    The same client (and hence the same ``Session`` and
+    connection pool) is shared by all threads.
 
     There's usually no need to call this function.
     It is automatically called by all query functions if
     you haven't passed in an explict `client` argument.
 
     """
-    global DEFAULT_CLIO_CLIENT
-
-    thread_id = threading.current_thread().ident
-    pid = os.getpid()
-
-    try:
-        c = CLIO_CLIENTS[(thread_id, pid)]
-    except KeyError:
-        if DEFAULT_CLIO_CLIENT is None:
-            raise RuntimeError(
-                "No default Client has been set yet. "
-                "Please create a Client object to serve as the default"
-            )
-
-        c = copy.deepcopy(DEFAULT_CLIO_CLIENT)
-        CLIO_CLIENTS[(thread_id, pid)] = c
+    if DEFAULT_CLIO_CLIENT is None:
+        raise RuntimeError(
+            "No default Client has been set yet. "
+            "Please create a Client object to serve as the default"
+        )
 
-    return c
+    return DEFAULT_CLIO_CLIENT
 
 
 def set_default_client(client):
@@ -83,15 +116,9 @@ def set_default_client(client):
     ``Client`` is created, but you can call it again
     to replace the default.
     """
-    global CLIO_CLIENTS
     global DEFAULT_CLIO_CLIENT
 
-    thread_id = threading.current_thread().ident
-    pid = os.getpid()
-
     DEFAULT_CLIO_CLIENT = client
-    CLIO_CLIENTS.clear()
-    CLIO_CLIENTS[(thread_id, pid)] = client
 
 
 def inject_client(f):
@@ -122,6 +149,53 @@ def inject_client(f):
     return wrapper
 
 
+def cache_clear():
+    """Clear cached data.
+
+    `clio-py` caches data that rarely changes (available datasets, fields,
+    the annotation schema, head node and version, IDs of annotated bodies,
+    etc.) for the duration of the session. Use this function if you know
+    that e.g. the schema has changed and you need `clio-py` to fetch it again.
+
+    This also deletes the on-disk cache of annotated body IDs.
+    """
+    from .pull import CACHE_DIR, _annotated_bodies, _annotated_bodies_index
+    from .push import _fetch_schema, _parse_schema, _validate_columns
+
+    for client in CLIO_CLIENTS:
+        client._head_uuid = client._head_version = client._meta = None
+        client._url_cache.clear()
+
+    for method in (
+        Client.fetch_datasets,
+        Client.fetch_roles,
+        Client.fetch_fields,
+        Client.fetch_versions,
+        Client.fetch_head_tag,
+        Client.fetch_head_uuid,
+        Client.tag_to_uuid,
+        Client.uuid_to_tag,
+    ):
+        method.cache_clear()
+
+    for func in (
+        _annotated_bodies,
+        _annotated_bodies_index,
+        _fetch_schema,
+        _parse_schema,
+        _validate_columns,
+    ):
+        func.cache_clear()
+
+    # Without this, the annotated bodies would just be re-loaded from disk
+    for fp in Path(CACHE_DIR).expanduser().glob("annotated_bodies_*.npy"):
+        try:
+            fp.unlink()
+        except OSError:
+            # E.g. on Windows if the file is still memory-mapped
+            pass
+
+
 def set_token(token):
     f"""Save Clio API token to {CLIO_TOKEN_FILE}.
 
@@ -165,7 +239,7 @@ def _unwrap_token(token):
     # A JSON document starts with "{"; a bare token never does.
     if token.startswith("{"):
         try:
-            token = ujson.loads(token)["token"]
+            token = orjson.loads(token)["token"]
         except Exception:
             raise RuntimeError(
                 "Did not understand token. Please provide the entire JSON "
@@ -228,7 +302,16 @@ def get_token_gcloud(google_identity_token=None, save=True):
     """
     # If not provided try using gcloud
     if not google_identity_token:
-        google_identity_token = os.popen("gcloud auth print-identity-token").read()
+        try:
+            google_identity_token = subprocess.run(
+                ["gcloud", "auth", "print-identity-token"],
+                capture_output=True,
+                text=True,
+                check=False,
+            ).stdout
+        except FileNotFoundError:
+            # gcloud is not installed - we'll raise below
+            google_identity_token = ""
 
     # Some clean-up
     google_identity_token = google_identity_token.strip()
@@ -329,6 +412,8 @@ class Client:
         # Setting self.token triggers validation and (once it exists) updates
         # the session header.
         self.token = token
+        # Makes sure that only one thread refreshes an expired token
+        self._token_lock = threading.Lock()
 
         if "://" not in server:
             server = "https://" + server
@@ -343,18 +428,39 @@ class Client:
             server = server[:-1]
 
         self.server = server
+        self._url_cache = {}
+        CLIO_CLIENTS.add(self)
 
         self.session = Session()
         self.session.headers.update(
             {
                 "Authorization": "Bearer " + self.token,
                 "Content-type": "application/json",
+                "Connection": "keep-alive",
             }
         )
 
-        # If the connection fails, retry a couple times.
-        retries = Retry(connect=2, backoff_factor=0.1)
-        self.session.mount("https://", HTTPAdapter(max_retries=retries))
+        # If the connection fails or the server is temporarily unavailable,
+        # retry a couple times. Note that POSTs are not retried.
+        retries = Retry(
+            connect=2,
+            status=2,
+            backoff_factor=0.1,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        # Use a large, blocking pool so that concurrent requests wait for
+        # a kept-alive connection rather than opening (and then dropping)
+        # additional ones.
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=32,
+                pool_maxsize=64,
+                pool_block=True,
+                max_retries=retries,
+            ),
+        )
 
         self.verify = verify
         if not verify:
@@ -385,6 +491,17 @@ class Client:
         if DEFAULT_CLIO_CLIENT is None:
             set_default_client(self)
 
+    def __getstate__(self):
+        # Locks can't be pickled (or deep-copied)
+        state = self.__dict__.copy()
+        state.pop("_token_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._token_lock = threading.Lock()
+        CLIO_CLIENTS.add(self)
+
     def __repr__(self):
         s = f'Client("{self.server}", "{self.dataset}"'
         if not self.verify:
@@ -399,10 +516,12 @@ class Client:
     @token.setter
     def token(self, token):
         # Make sure token is principally valid
-        self._validate_token(token)
+        decoded = self._validate_token(token)
 
-        # Set token
+        # Set token and cache its expiry so we don't have to decode the JWT
+        # on every request
         self._token = token
+        self._token_exp = int(decoded["exp"]) if decoded else None
 
         # Update session header
         if hasattr(self, "session"):
@@ -433,30 +552,19 @@ class Client:
             self._meta = self._fetch_json(f"{self.server}/v2/datasets")[self.dataset]
         return self._meta
 
-    def _add_identifier(self, url):
-        """Add identifier to URL."""
-        url_parts = list(urlparse.urlparse(url))
-        query = dict(urlparse.parse_qsl(url_parts[4]))
-
-        if "app" not in query:
-            query.update({"app": "clio-py"})
-
-        url_parts[4] = urlencode(query)
-
-        return urlparse.urlunparse(url_parts)
-
     def make_url(self, *args, test=False, **GET):
         """Generates URL."""
-        # Generate the URL
-        if not test:
-            url = self.server
-        else:
-            url = CLIO_TEST_STORE
-        for arg in args:
-            arg_str = str(arg)
-            joiner = "" if url.endswith("/") else "/"
-            relative = arg_str[1:] if arg_str.startswith("/") else arg_str
-            url = requests.compat.urljoin(url + joiner, relative)
+        # The same few endpoints are requested over and over, so we cache
+        # the path part of the URL. Note that the key has to include the
+        # base URL since `self.server` may be changed at any time.
+        base = self.server if not test else CLIO_TEST_STORE
+        key = (base, *(str(arg) for arg in args))
+        try:
+            url = self._url_cache[key]
+        except KeyError:
+            # Generate the URL
+            url = "/".join([base.rstrip("/"), *(arg.strip("/") for arg in key[1:])])
+            self._url_cache[key] = url
         if GET:
             url += "?{}".format(urllib.parse.urlencode(GET))
         return url
@@ -472,23 +580,18 @@ class Client:
         Returns ``None`` for opaque (non-JWT) tokens, whose expiry cannot be
         read locally; the server remains the source of truth in that case.
         """
-        try:
-            decoded = jwt.decode(
-                self.token, algorithms=["HS256"], options={"verify_signature": False}
-            )
-        except jwt.PyJWTError:
+        if self._token_exp is None:
             return None
 
-        if "exp" not in decoded:
-            return None
-
-        return int(decoded["exp"]) - int(time.time())
+        return self._token_exp - int(time.time())
 
     def _validate_token(self, token=None):
         """Basic sanity check on a token.
 
         Opaque (non-JWT) tokens are accepted as-is; the expected fields are
         only enforced when the token is a decodable JWT.
+
+        Returns the decoded JWT claims, or ``None`` for opaque tokens.
         """
         if token is None:
             token = self.token
@@ -502,7 +605,7 @@ class Client:
             )
         except jwt.PyJWTError:
             # Not a JWT (e.g. an opaque server-issued token) -- accept as-is.
-            return
+            return None
 
         for field in ["email", "exp"]:
             if field not in decoded:
@@ -511,21 +614,55 @@ class Client:
                     f"is therefore invalid: {decoded}"
                 )
 
-    def _fetch(self, url, json=None, ispost=False, identify=True):
-        time_left = self.token_time_left()
-        if time_left is not None and time_left < 0:
-            print("Clio token expired. Attempting refresh...")
-            self.refresh_token()
+        return decoded
+
+    def _fetch(
+        self,
+        url,
+        json=None,
+        ispost=False,
+        identify=True,
+        stream=False,
+        data=None,
+        headers=None,
+    ):
+        """Make a GET or POST request.
+
+        For POST requests, the body is either given as a JSON-serializable
+        object (`json`) or as already serialized JSON bytes (`data`).
+        `headers` are added to the session's default headers.
+        """
+        if self._token_exp is not None and time.time() >= self._token_exp:
+            with self._token_lock:
+                # Another thread may have refreshed the token in the meantime
+                if self._token_exp is not None and time.time() >= self._token_exp:
+                    print("Clio token expired. Attempting refresh...")
+                    self.refresh_token()
 
         # Make sure URL has identifier
         if identify:
-            url = self._add_identifier(url)
+            url = _add_identifier(url)
 
         if ispost:
-            r = self.session.post(url, json=json, verify=self.verify)
+            # Serialize the body ourselves: orjson is much faster than the
+            # stdlib json that requests would use. The session already sends
+            # the "application/json" content type.
+            if json is not None:
+                assert data is None, "Provide either `json` or `data`, not both"
+                data = _dumps(json)
+            r = self.session.post(
+                url, data=data, headers=headers, verify=self.verify, stream=stream
+            )
         else:
-            assert json is None, "Can't provide a body via GET method"
-            r = self.session.get(url, verify=self.verify)
+            assert json is None and data is None, "Can't provide a body via GET method"
+            r = self.session.get(
+                url, headers=headers, verify=self.verify, stream=stream
+            )
+        if not r.ok:
+            # Read the (usually short) error message before raising: this
+            # keeps it available as `e.response.text` even for streamed
+            # responses and releases the connection back to the pool
+            r.content
         r.raise_for_status()
         return r
 
@@ -533,12 +670,15 @@ class Client:
         return self._fetch(url, json=json, ispost=ispost, identify=identify).content
 
     def _fetch_json(self, url, json=None, ispost=False, identify=True):
-        r = self._fetch(url, json=json, ispost=ispost, identify=identify)
-        return ujson.loads(r.content)
+        # Stream the response and parse the raw bytes directly: this avoids
+        # requests caching a second copy of large payloads in `r.content`
+        r = self._fetch(url, json=json, ispost=ispost, identify=identify, stream=True)
+        with r:
+            return orjson.loads(r.raw.read(decode_content=True))
 
     def _fetch_pandas(self, url, json=None, ispost=False, identify=True):
         r = self._fetch_json(url, json=json, ispost=ispost, identify=identify)
-        return pd.DataFrame.from_records(r)
+        return pd.DataFrame(r)
 
     ##
     ## DB-META
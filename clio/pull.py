@@ -1,11 +1,21 @@
+import re
+import time
+import functools
 import requests
+import threading
 import urllib.parse
 
 import dvid as dv
 import numpy as np
+import orjson
 import pandas as pd
 
+from pathlib import Path
 from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry, make_headers
 
 from .client import inject_client
 
@@ -15,10 +25,49 @@ __all__ = [
     "ids_exist",
 ]
 
+# Where to cache data on disk
+CACHE_DIR = "~/.cache/clio"
+# Max age [s] of the on-disk cache of annotated body IDs
+ANNOTATED_BODIES_MAX_AGE = 24 * 60 * 60
+
+# Max number of body IDs per query in `fetch_annotations`
+FETCH_CHUNKSIZE = 5000
+# Max number of body IDs per DVID query in `ids_exist`
+IDS_EXIST_CHUNKSIZE = 10_000
+# Max number of parallel requests
+FETCH_MAX_WORKERS = 8
+
+
+def _make_session():
+    """Make a pooled session for talking to DVID directly."""
+    session = requests.Session()
+    session.headers.update(
+        {
+            # Advertise all compressions urllib3 can decode here (includes
+            # brotli/zstd if the respective packages are installed)
+            "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"],
+            "Accept": "application/json",
+        }
+    )
+    retries = Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared (thread-safe) session for DVID requests
+_SESSION = _make_session()
+
 
 @inject_client
 def fetch_annotations(
-    bodyid=None, *, version=None, show_extra=None, client=None, **kwargs
+    bodyid=None, *, version=None, show_extra=None, batch=False, client=None, **kwargs
 ):
     """Fetch annotations for given body ID(s).
 
@@ -32,6 +81,11 @@ def fetch_annotations(
                 Version string, e.g. "v0.3.5" to fetch annotations for.
     show_extra : None | "user" | |time" | "all"
                 Whether to also pull "_user" or "_time" fields or both.
+    batch :     bool
+                If True and `bodyid` is a single ID, the query is briefly
+                held back and merged with other single-ID queries made at
+                the same time (e.g. from other threads) into one request.
+                Only useful if you are calling this function concurrently.
     **kwargs
                 Keyword arguments can be used to provide (additional) filters.
                 See examples.
@@ -41,7 +95,9 @@ def fetch_annotations(
     Fetch annotations for a single body
     >>> clio.fetch_annotations(154109)
 
-    Fetch annotations for a multiple bodies
+    Fetch annotations for a multiple bodies. This is much faster than
+    calling the function for each body individually: all IDs are fetched
+    in one go (large lists are split into chunks fetched in parallel)
     >>> clio.fetch_annotations([154109, 24053])
 
     Fetch annotations by neuron status
@@ -65,6 +121,22 @@ def fetch_annotations(
 
     """
     assert show_extra in (None, "user", "time", "all")
+
+    if batch and isinstance(bodyid, (str, int, np.integer)):
+        key = (
+            client,
+            version,
+            show_extra,
+            tuple(sorted((k, repr(v)) for k, v in kwargs.items())),
+        )
+        return _BATCHER.submit(
+            key,
+            int(bodyid),
+            lambda ids: fetch_annotations(
+                ids, version=version, show_extra=show_extra, client=client, **kwargs
+            ),
+        ).result()
+
     GET = {}
     if show_extra is not None:
         GET["show"] = show_extra
@@ -76,47 +148,159 @@ def fetch_annotations(
     if version is not None:
         GET["version"] = version
 
-    url = client.make_url(
-        "v2/json-annotations/", client.dataset, "neurons/query", **GET
-    )
-
-    query = kwargs
     # Strip leading or trailing underscores (for e.g. "_class")
-    for k, v in query.items():
-        if k.startswith("_"):
-            query.pop(k)
-            query[k[1:]] = v
-        elif k.endswith("_"):
-            query.pop(k)
-            query[k[:-1]] = v
+    query = {
+        (k[1:] if k.startswith("_") else k[:-1] if k.endswith("_") else k): v
+        for k, v in kwargs.items()
+    }
 
     if not isinstance(bodyid, type(None)):
-        if isinstance(bodyid, (str, int)):
+        if isinstance(bodyid, (str, int, np.integer)):
             bodyid = [bodyid]
-        bodyid = np.unique(np.asarray(bodyid).astype(int)).tolist()
+        # No need for `.tolist()`: our JSON encoder can serialize numpy arrays
+        bodyid = pd.unique(np.asarray(bodyid, dtype=np.int64))
         query["bodyid"] = bodyid
 
-    an = client._fetch_pandas(url, json=query, ispost=True)
+    an = _query_annotations(query, GET, client=client)
 
     if not isinstance(bodyid, type(None)):
-        if not an.empty:
-            miss = ~np.isin(bodyid, an.bodyid)
-        else:
-            miss = np.ones(len(bodyid), dtype=bool)
+        miss = _not_in(bodyid, an)
 
-        if any(miss):
+        if miss.any():
             # Check if any of the body IDs do not exists
-            exists = ids_exist(np.array(bodyid)[miss], client=client)
-            if any(~exists):
+            missing = bodyid[miss]
+            exists = ids_exist(missing, client=client)
+            if not exists.all():
                 print(
                     "The following body IDs do not appear to exist in the "
                     f"head node {client.head_uuid}: "
                 )
-                print(", ".join(np.array(bodyid)[miss][~exists].astype(str)))
+                print(", ".join(missing[~exists].astype(str)))
 
     return an
 
 
+def _query_annotations(query, GET, client):
+    """Query annotations.
+
+    Parameters
+    ----------
+    query :     dict
+                The query, e.g. `{"bodyid": [...], "status": "Anchor"}`. Large
+                lists of body IDs are split into chunks fetched in parallel.
+    GET :       dict
+                Dictionary of GET parameters.
+    client :    clio.Client
+
+    Returns
+    -------
+    annotations :   pandas.DataFrame
+
+    """
+    url = client.make_url(
+        "v2/json-annotations/", client.dataset, "neurons/query", **GET
+    )
+
+    bodyid = query.get("bodyid")
+    if bodyid is None or len(bodyid) <= FETCH_CHUNKSIZE:
+        return client._fetch_pandas(url, json=query, ispost=True)
+
+    # Split very large queries into chunks to avoid timeouts and run
+    # them in parallel over the client's connection pool
+    chunks = [
+        {**query, "bodyid": bodyid[i : i + FETCH_CHUNKSIZE]}
+        for i in range(0, len(bodyid), FETCH_CHUNKSIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as pool:
+        results = list(
+            pool.map(lambda q: client._fetch_pandas(url, json=q, ispost=True), chunks)
+        )
+    return pd.concat(results, ignore_index=True)
+
+
+def _not_in(bodyid, an):
+    """Mask for the body IDs that are not in annotations `an`."""
+    if an.empty:
+        return np.ones(len(bodyid), dtype=bool)
+    return pd.Index(an.bodyid.values).unique().get_indexer(bodyid) == -1
+
+
+class _Batcher:
+    """Coalesces concurrent single-ID queries into one request.
+
+    Queries with the same key are collected until no new query has come in
+    for `wait` seconds (but at most for `max_wait` seconds). The collected
+    IDs are then fetched in one go and the results are split up again.
+
+    Parameters
+    ----------
+    wait :      float
+                Seconds to wait for further queries before fetching.
+    max_wait :  float
+                Max seconds to hold back the first query of a batch.
+
+    """
+
+    def __init__(self, wait=0.06, max_wait=0.25):
+        self.wait = wait
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def submit(self, key, bodyid, fetch):
+        """Queue `bodyid`; `fetch` is called with the list of all queued IDs."""
+        future = Future()
+        with self._lock:
+            now = time.monotonic()
+            batch = self._pending.get(key)
+            new = batch is None
+            if new:
+                batch = self._pending[key] = {
+                    "ids": [],
+                    "futures": [],
+                    "fetch": fetch,
+                    "start": now,
+                }
+            batch["ids"].append(bodyid)
+            batch["futures"].append(future)
+
+            # Push the flush back, unless we are already at `max_wait`
+            batch["deadline"] = min(now + self.wait, batch["start"] + self.max_wait)
+
+        # A single thread per batch waits for the (moving) deadline - we
+        # don't want to start a new timer thread for every queued ID
+        if new:
+            threading.Thread(target=self._flush, args=(key, batch), daemon=True).start()
+
+        return future
+
+    def _flush(self, key, batch):
+        """Wait until `batch` is due, then fetch it."""
+        while True:
+            with self._lock:
+                delay = batch["deadline"] - time.monotonic()
+                if delay <= 0:
+                    del self._pending[key]
+                    break
+            time.sleep(delay)
+
+        try:
+            an = batch["fetch"](batch["ids"])
+        except BaseException as e:
+            for future in batch["futures"]:
+                future.set_exception(e)
+            return
+
+        rows = an.groupby("bodyid").indices if not an.empty else {}
+        for bodyid, future in zip(batch["ids"], batch["futures"]):
+            future.set_result(
+                an.iloc[rows.get(bodyid, [])].reset_index(drop=True)
+            )
+
+
+_BATCHER = _Batcher()
+
+
 def _fetch_all_annotations(GET, version, client):
     """Fetch all annotations going straight to the DVID server.
 
@@ -141,9 +325,14 @@ def _fetch_all_annotations(GET, version, client):
     if GET:
         url += "?{}".format(urllib.parse.urlencode(GET))
 
-    r = requests.get(url)
-    r.raise_for_status()
-    return pd.DataFrame.from_records(r.json())
+    # Stream the response and parse the raw bytes directly: this avoids
+    # requests caching a second copy of this (large) payload in `r.content`
+    with _SESSION.get(url, stream=True) as r:
+        if not r.ok:
+            # Read DVID's error message before the response is closed
+            r.content
+        r.raise_for_status()
+        return pd.DataFrame(orjson.loads(r.raw.read(decode_content=True)))
 
 
 @inject_client
@@ -189,35 +378,81 @@ def ids_exist(bodyid, *, client=None):
                 Array of True/False.
 
     """
-    if isinstance(bodyid, (str, int)):
+    if isinstance(bodyid, (str, int, np.integer)):
         bodyid = [bodyid]
 
-    bodyid = np.asarray(bodyid).astype(int)
+    bodyid = np.asarray(bodyid, dtype=np.int64)
+
+    # Check each ID only once
+    uniq, inverse = np.unique(bodyid, return_inverse=True)
 
     # It is much faster to ask if a body has an annotation than it is to
     # check if a body ID exists
-    exists = np.zeros(len(bodyid), dtype=bool)
-    exists[np.isin(bodyid, _annotated_bodies(client=client))] = True
-
-    if any(~exists):
-        exists[
-            dv.ids_exist(
-                bodyid,
-                progress=False,
-                server=client.meta["dvid"],
-                node=client.head_uuid,
-            )
-        ] = True
+    exists = _annotated_bodies_index(client=client).get_indexer(uniq) >= 0
+
+    # Ask DVID only about the IDs we haven't found yet
+    miss = np.flatnonzero(~exists)
+    if len(miss):
+        check = functools.partial(
+            dv.ids_exist,
+            progress=False,
+            server=client.meta["dvid"],
+            node=client.head_uuid,
+        )
+        # dvidtools queries sequentially, so for many IDs we split them into
+        # chunks and query those in parallel (it uses one session per thread)
+        chunks = [
+            uniq[miss[i : i + IDS_EXIST_CHUNKSIZE]]
+            for i in range(0, len(miss), IDS_EXIST_CHUNKSIZE)
+        ]
+        if len(chunks) == 1:
+            exists[miss] = check(chunks[0])
+        else:
+            with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as pool:
+                exists[miss] = np.concatenate(list(pool.map(check, chunks)))
 
-    return exists
+    return exists[inverse.ravel()]
+
+
+@lru_cache
+@inject_client
+def _annotated_bodies_index(*, client=None):
+    """Index of currently annotated bodies for fast (hash-based) lookups."""
+    # pandas builds the hash table on first lookup and keeps it with the index
+    return pd.Index(_annotated_bodies(client=client)).unique()
 
 
 @lru_cache
 @inject_client
 def _annotated_bodies(*, client=None):
-    """Get IDs of currently annotated bodies."""
+    """Get IDs of currently annotated bodies.
+
+    The IDs are also cached on disk (per dataset and head node) for
+    `ANNOTATED_BODIES_MAX_AGE` seconds so that new sessions don't have to
+    download them again.
+    """
+    name = re.sub(r"[^\w.-]", "_", f"{client.dataset}_{client.head_uuid}")
+    fp = Path(CACHE_DIR).expanduser() / f"annotated_bodies_{name}.npy"
+
+    try:
+        if time.time() - fp.stat().st_mtime < ANNOTATED_BODIES_MAX_AGE:
+            return np.load(fp, mmap_mode="r")
+    except (OSError, ValueError):
+        # No (valid) cache file
+        pass
+
     url = client.meta["dvid"] + "/api/node/:master/segmentation_annotations/keys"
-    r = requests.get(url)
+    r = _SESSION.get(url)
     r.raise_for_status()
-    return np.array(r.json()).astype(int)
+    keys = orjson.loads(r.content)
+    keys = np.fromiter(keys, dtype=np.int64, count=len(keys))
+
+    try:
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        np.save(fp, keys)
+    except OSError:
+        # Caching is best effort
+        pass
+
+    return keys
 
@@ -1,25 +1,49 @@
-import requests
+import gzip
 
 import numpy as np
+import orjson
 import pandas as pd
 
 from functools import lru_cache
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from tqdm.auto import tqdm
 
-from .client import inject_client
-from .pull import fetch_annotations, ids_exist
+from .client import inject_client, _dumps
+from .pull import ids_exist, _not_in, _query_annotations, _SESSION
 
 __all__ = [
     "set_annotations",
     "set_fields",
 ]
 
+# Default target size [bytes] of a single upload request if no chunksize is given
+UPLOAD_TARGET_BYTES = 1024 * 1024
+
 TYPES_MAPPING = {
     "integer": (int, np.integer, np.int64, np.int32),
     "string": (str, object),
     "array": (object, np.ndarray),
     "boolean": (bool,),
 }
+# Same as above but as numpy dtype kinds for non-object columns
+TYPES_KINDS = {
+    "integer": "iu",
+    "string": "OSU",
+    "array": "O",
+    "boolean": "b",
+}
+# Labels `pd.api.types.infer_dtype` gives object columns that contain only
+# (or no) values of the types in TYPES_MAPPING. Types without an entry here
+# accept any object.
+TYPES_INFERRED = {
+    "integer": ("integer", "boolean", "empty"),
+    "boolean": ("boolean", "empty"),
+}
 
 
 @inject_client
@@ -30,8 +54,11 @@ def set_fields(
     version=None,
     protect=("user",),
     validate=True,
-    chunksize=50,
+    chunksize=None,
+    target_bytes=UPLOAD_TARGET_BYTES,
     progress=True,
+    max_workers=8,
+    compress=False,
     client=None,
     **fields,
 ):
@@ -68,10 +95,23 @@ def set_fields(
                 Whether to validate the schema of the annotations before
                 (highly recommended). If set to False, the schema will not be
                 checked and the annotations will be sent as is.
-    chunksize : int
-                Number of annotations uploaded in one go.
+    chunksize : int, optional
+                Number of annotations uploaded in one go. If not provided,
+                will pick a chunksize such that each request is roughly
+                `target_bytes` large. Note that this used to default to 50
+                annotations per request; with the default `target_bytes`
+                this is now typically several thousand.
+    target_bytes : int
+                Target size [bytes] of a single request. Ignored if
+                `chunksize` is provided.
     progress :  bool
                 Whether to show a progress bar for the upload. Defaults to True.
+    max_workers : int
+                Max number of chunks uploaded in parallel.
+    compress :  bool
+                Whether to gzip the uploaded data. This saves bandwidth on
+                slow connections but requires the server to accept
+                gzip-encoded requests.
 
     Notes
     -----
@@ -112,9 +152,12 @@ def set_fields(
         protect=protect,
         validate=validate,
         chunksize=chunksize,
+        target_bytes=target_bytes,
         client=client,
         write_empty_fields=True,
         progress=progress,
+        max_workers=max_workers,
+        compress=compress,
     )
 
 
@@ -127,8 +170,11 @@ def set_annotations(
     write_empty_fields=False,
     protect=("user",),
     validate=True,
-    chunksize=50,
+    chunksize=None,
+    target_bytes=UPLOAD_TARGET_BYTES,
     progress=True,
+    max_workers=8,
+    compress=False,
     client=None,
 ):
     """Set annotations for given body ID(s).
@@ -163,10 +209,23 @@ def set_annotations(
                 Whether to validate the schema of the annotations before
                 (highly recommended). If set to False, the schema will not be
                 checked and the annotations will be sent as is.
-    chunksize : int
-                Number of annotations uploaded in one go.
+    chunksize : int, optional
+                Number of annotations uploaded in one go. If not provided,
+                will pick a chunksize such that each request is roughly
+                `target_bytes` large. Note that this used to default to 50
+                annotations per request; with the default `target_bytes`
+                this is now typically several thousand.
+    target_bytes : int
+                Target size [bytes] of a single request. Ignored if
+                `chunksize` is provided.
     progress :  bool
                 Whether to show a progress bar for the upload. Defaults to True.
+    max_workers : int
+                Max number of chunks uploaded in parallel.
+    compress :  bool
+                Whether to gzip the uploaded data. This saves bandwidth on
+                slow connections but requires the server to accept
+                gzip-encoded requests.
 
     Notes
     -----
@@ -186,8 +245,8 @@ def set_annotations(
 
     if isinstance(x, dict):
         if not (
-            all([isinstance(k, int) for k in x.keys()])
-            and all([isinstance(v, dict) for v in x.values()])
+            all(isinstance(k, int) for k in x.keys())
+            and all(isinstance(v, dict) for v in x.values())
         ):
             raise ValueError(
                 "If `x` is dictionary it must be `{bodyid: {field: value}}`"
@@ -199,63 +258,77 @@ def set_annotations(
     if validate:
         _validate_schema(x, client)
 
-    x = x.copy()
-    x["bodyid"] = x.bodyid.astype(int)
-
-    if any(x.bodyid.duplicated()):
-        raise ValueError("Table contains duplicate body IDs.")
+    # Note: we don't modify (or copy) `x` itself - only the body IDs
+    bodyid = x.bodyid.to_numpy()
 
-    if any(x.bodyid.isnull()):
+    # Integer columns can't contain nulls - no need to check those
+    if bodyid.dtype.kind not in "iu" and pd.isnull(bodyid).any():
         raise ValueError("Table contains empty body IDs.")
 
-    an = x.to_dict(orient="records")
+    # This is a no-op if body IDs already are int64
+    bodyid = np.asarray(bodyid, dtype=np.int64)
 
-    # Drop empty entries
+    uniq, counts = np.unique(bodyid, return_counts=True)
+    if (counts > 1).any():
+        raise ValueError(
+            f"Table contains duplicate body IDs: {uniq[counts > 1].tolist()}"
+        )
+
+    # Mask of the values we want to write
     if not write_empty_fields:
-        an = [{k: v for k, v in at.items() if not pd.isnull(v)} for at in an]
+        keep = x.notna().to_numpy(copy=True)
+    else:
+        keep = np.ones(x.shape, dtype=bool)
 
     # Check if any of the body IDs do not exists
-    exists = ids_exist(x.bodyid.values.tolist(), client=client)
-    if any(~exists):
+    if protect is not False:
+        # If we need to protect any fields, we have to fetch the existing
+        # annotations anyway. The two requests are independent, so we run
+        # them concurrently instead of one after the other
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            f_existing = pool.submit(
+                _query_annotations, {"bodyid": bodyid}, {}, client=client
+            )
+            f_exists = pool.submit(ids_exist, bodyid, client=client)
+            existing = f_existing.result()
+            exists = f_exists.result()
+        # Bodies with annotations obviously exist (even if they have only been
+        # annotated after we cached the list of annotated bodies)
+        exists[~_not_in(bodyid, existing)] = True
+    else:
+        exists = ids_exist(bodyid, client=client)
+
+    if not exists.all():
         raise ValueError(
             "The following body IDs do not appear to exist in the "
             f"head node {client.head_uuid}: "
-            f"{', '.join(x.bodyid.values[~exists].astype(str))}"
+            f"{', '.join(bodyid[~exists].astype(str))}"
         )
 
-    # See if we need to protect any fields
     if protect is not False:
-        existing = fetch_annotations(x.bodyid.values.tolist(), client=client)
-
         if not existing.empty:
-            existing = existing.set_index("bodyid").to_dict(orient="index")
-        else:
-            existing = {}
-
-        # Turn into this format: {bodyId: ['user', 'type', ...]} for existing fields
-        existing = {k: list(v) for k, v in existing.items()}
-
-        # Remove any field that already has a value
-        if protect is True:
-            an = [
-                {k: v for k, v in at.items() if k not in existing.get(at["bodyid"], [])}
-                for at in an
-            ]
-        else:
-            an = [
-                {
-                    k: v
-                    for k, v in at.items()
-                    if k not in existing.get(at["bodyid"], []) or k not in protect
-                }
-                for at in an
-            ]
-
-    # Drop any record that is only {'bodyid'}
-    an = [a for a in an if len(a) > 1]
-
-    # Replace any np.nan with None
-    an = [{k: v if not pd.isnull(v) else None for k, v in a.items()} for a in an]
+            # Mask of the fields that already have a value in Clio
+            is_set = (
+                existing.set_index("bodyid")
+                .notna()
+                .reindex(index=bodyid, columns=x.columns, fill_value=False)
+            )
+            if protect is not True:
+                is_set.loc[:, ~is_set.columns.isin(protect)] = False
+
+            # Don't overwrite protected fields that already have a value
+            keep &= ~is_set.to_numpy(dtype=bool)
+
+    # Drop any record that is only {'bodyid'} and any column we don't write
+    # to at all before building the records
+    has_data = keep.sum(axis=1) > 1
+    keep = keep[has_data]
+    has_cols = keep.any(axis=0)
+    has_cols[x.columns.get_loc("bodyid")] = True
+    keep = keep[:, has_cols]
+    bodyid = bodyid[has_data]
+    columns = x.columns[has_cols].tolist()
+    values = x.loc[has_data, has_cols]
 
     if version is None:
         version = client.head_version
@@ -264,41 +337,126 @@ def set_annotations(
         "v2/json-annotations/", client.dataset, f"neurons?{version}", test=test
     )
 
+    if chunksize is None:
+        sample = next(_iter_chunks(values, columns, keep, bodyid, 100), [])
+        chunksize = _auto_chunksize(sample, target_bytes)
+
+    # Upload chunks in parallel: this is network-bound and requests releases
+    # the GIL while waiting for the server. Chunks are generated lazily and
+    # we limit the number of chunks in flight, so that we never hold all
+    # records in memory at once.
     with tqdm(
-        total=len(an), desc="Writing annotations", leave=False, disable=not progress
-    ) as pbar:
-        for i in range(0, len(an), chunksize):
-            chunk = an[i : i + chunksize]
-            r = client._fetch(url, json=chunk, ispost=True)
-            r.raise_for_status()
-            pbar.update(len(chunk))
+        total=len(values),
+        desc="Writing annotations",
+        leave=False,
+        disable=not progress,
+    ) as pbar, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            pending = set()
+            for chunk in _iter_chunks(values, columns, keep, bodyid, chunksize):
+                if len(pending) >= 2 * max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        pbar.update(f.result())
+                pending.add(pool.submit(_post_chunk, url, chunk, client, compress))
+            for f in as_completed(pending):
+                pbar.update(f.result())
+        except BaseException:
+            # Don't start uploading any more chunks
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
 
     return
 
 
+def _iter_chunks(values, columns, keep, bodyid, chunksize):
+    """Lazily generate lists of (at most) `chunksize` records."""
+    for i in range(0, len(values), chunksize):
+        j = i + chunksize
+        yield _build_records(values.iloc[i:j], columns, keep[i:j], bodyid[i:j])
+
+
+def _build_records(values, columns, keep, bodyid):
+    """Turn (a slice of) the table into a list of `{field: value}` records.
+
+    Note that empty values (NaN, None, pd.NA, etc.) are passed through as
+    they are: `_dumps` takes care of writing them as `null`.
+    """
+    values = values.to_numpy(dtype=object, copy=True)
+    values[:, columns.index("bodyid")] = bodyid
+
+    # Iterating over (nested) lists is much faster than over numpy rows
+    values = values.tolist()
+
+    if keep.all():
+        # Fast path: we write every value of every record
+        return [dict(zip(columns, row)) for row in values]
+
+    return [
+        {k: v for k, v, m in zip(columns, row, mask) if m}
+        for row, mask in zip(values, keep.tolist())
+    ]
+
+
+def _post_chunk(url, chunk, client, compress=False):
+    """Upload a single chunk of annotations and return its size."""
+    if compress:
+        # Level 1 is much faster than the default and compresses our highly
+        # repetitive JSON (same field names in every record) almost as well
+        r = client._fetch(
+            url,
+            data=gzip.compress(_dumps(chunk), compresslevel=1),
+            headers={"Content-Encoding": "gzip"},
+            ispost=True,
+        )
+    else:
+        r = client._fetch(url, json=chunk, ispost=True)
+    r.raise_for_status()
+    return len(chunk)
+
+
+def _auto_chunksize(sample, target_bytes=UPLOAD_TARGET_BYTES):
+    """Number of records per request to get ~`target_bytes` requests.
+
+    The size per record is estimated from given `sample` of records.
+    """
+    if not sample:
+        return 1
+    size = len(_dumps(sample)) / len(sample)
+    return max(1, int(target_bytes // size))
+
+
 @lru_cache
-def _get_schema(client):
-    """Get schema for annotations."""
-    ds = client.fetch_datasets()[client.dataset]
+def _fetch_schema(server):
+    """Fetch annotation schema from given DVID server.
 
-    url = f"{ds['dvid']}/api/node/:master/segmentation_annotations/json_schema"
-    r = requests.get(url)
-    return r.json()
+    Cached per server so that it is shared between clients (and never changes
+    within a session anyway).
+    """
+    url = f"{server}/api/node/:master/segmentation_annotations/json_schema"
+    r = _SESSION.get(url)
+    r.raise_for_status()
+    return orjson.loads(r.content)
 
 
-def _validate_schema(x, client):
-    """Validate `x` against expected schema."""
-    schema = _get_schema(client)
+@lru_cache
+def _parse_schema(server):
+    """Compile the column types in the annotation schema into checks.
 
-    for val in schema["required"]:
-        if val not in x.columns:
-            raise ValueError(f'Missing required "{val}" column.')
+    Cached so that we only have to do this once per server.
 
-    # Note that this does not seem to contain specs for all available fields
-    for col, specs in schema["properties"].items():
-        # Make sure not to mess with the original schema!
-        specs = specs.copy()
+    Returns
+    -------
+    dict
+                `{column: (expected_types, kinds, inferred, nullable)}` where
+                `expected_types` is from `TYPES_MAPPING`, `kinds` from
+                `TYPES_KINDS` and `inferred` from `TYPES_INFERRED` (None if
+                any value is allowed).
 
+    """
+    types = {}
+    # Note that this does not seem to contain specs for all available fields
+    for col, specs in _fetch_schema(server)["properties"].items():
         # Specs is a dictionary containing either:
         #  - a single "type" ({'type': 'string'}),
         #  - a list of types ({'type': ['string', 'null']})
@@ -312,44 +470,85 @@ def _validate_schema(x, client):
         if isinstance(specs["type"], list):
             nullable = "null" in specs["type"]
             # Drop "null" from the list
-            specs["type"] = [t for t in specs["type"] if t != "null"]
+            type_ = [t for t in specs["type"] if t != "null"]
             # If list is only one entry then unpack it
-            if len(specs["type"]) == 1:
-                specs["type"] = specs["type"][0]
+            if len(type_) == 1:
+                type_ = type_[0]
             else:
                 raise ValueError(
-                    "Unexpected list of accepted types for "
-                    f"column {col}: {specs['type']}"
+                    f"Unexpected list of accepted types for column {col}: {type_}"
                 )
         else:
-            nullable = specs["type"] == "null"
+            type_ = specs["type"]
+            nullable = type_ == "null"
+
+        types[col] = (
+            TYPES_MAPPING[type_],
+            TYPES_KINDS[type_],
+            TYPES_INFERRED.get(type_),
+            nullable,
+        )
+
+    return types
+
+
+def _validate_schema(x, client):
+    """Validate `x` against expected schema."""
+    server = client.fetch_datasets()[client.dataset]["dvid"]
+
+    # Checks that only depend on the columns and their dtypes are cached
+    _validate_columns(server, client, tuple(x.columns), tuple(x.dtypes))
 
-        if col in x.columns:
-            expected_types = TYPES_MAPPING[specs["type"]]
+    # Values in object columns have to be checked every time.
+    # Note: pandas will use `object` as datatype for integer columns if they
+    # also contain `None`.
+    columns = set(x.columns)
+    for col, (expected_types, _, inferred, nullable) in _parse_schema(server).items():
+        if col not in columns or x[col].dtype.kind != "O":
+            continue
 
-            # Note: pandas will use `object` as datatype for integer columns if they
-            # also contain `None`.
-            if x[col].dtype.kind == "O":
-                if not nullable and x[col].isnull().any():
-                    raise ValueError(
-                        f'Column "{col}" is not allowed to contain null values.'
+        if not nullable and x[col].isnull().any():
+            raise ValueError(f'Column "{col}" is not allowed to contain null values.')
+
+        # Any value is an instance of `object`, so there is nothing
+        # to check for e.g. strings. For the other types, have pandas
+        # classify the column in one go and only check individual
+        # values if that doesn't tell us the column is fine
+        if inferred and pd.api.types.infer_dtype(x[col], skipna=True) not in inferred:
+            for val in x[col].dropna():
+                if not isinstance(val, expected_types):
+                    raise TypeError(
+                        f'Column "{col}" should be of type(s) {expected_types}, '
+                        f"got {type(val)}"
                     )
 
-                if x[col].notnull().any():
-                    # Check individual values
-                    for val in x[col].dropna():
-                        if not any([isinstance(val, t) for t in expected_types]):
-                            raise TypeError(
-                                f'Column "{col}" should be of type(s) {expected_types}, '
-                                f"got {type(val)}"
-                            )
-            elif x[col].dtype not in expected_types:
-                raise TypeError(
-                    f'Column "{col}" should be of type(s) {expected_types}, '
-                    f"got {x[col].dtype}"
-                )
 
-    fields = client.fetch_fields()
-    wrong = x.columns[~np.isin(x.columns, fields)]
-    if any(wrong):
+@lru_cache(maxsize=128)
+def _validate_columns(server, client, columns, dtypes):
+    """Validate column names and (non-object) dtypes against the schema.
+
+    Since exceptions are not cached, this remembers only column layouts that
+    passed validation.
+    """
+    schema = _fetch_schema(server)
+
+    for val in schema["required"]:
+        if val not in columns:
+            raise ValueError(f'Missing required "{val}" column.')
+
+    types = _parse_schema(server)
+    for col, dtype in zip(columns, dtypes):
+        if col not in types or dtype.kind == "O":
+            continue
+
+        expected_types, kinds = types[col][:2]
+        if dtype.kind not in kinds:
+            raise TypeError(
+                f'Column "{col}" should be of type(s) {expected_types}, '
+                f"got {dtype}"
+            )
+
+    fields = set(client.fetch_fields())
+    wrong = [c for c in columns if c not in fields]
+    if wrong:
         raise ValueError(f"The following columns appear to be invalid fields: {wrong}")